@@ -1,177 +1,1137 @@
 # html-to-pdf-service/app.py
+import codecs
+import hashlib
+import io
 import os
+import queue
+import re
+import socket
 import subprocess
-import tempfile
 import time
-import sys
-from flask import Flask, request, send_file, jsonify
-import traceback
+import uuid
+import logging
+import tempfile
+import atexit
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import orjson
+from flask import Flask, Response, request, jsonify, stream_with_context
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+# Logging goes to stderr (picked up by `docker-compose logs`). The default INFO level keeps
+# per-request details out of the hot path; set LOG_LEVEL=DEBUG to trace every conversion.
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s [%(process)d] [%(levelname)s] %(name)s: %(message)s',
+)
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Reject request bodies larger than this (default 64MB) with 413 before they are read into memory
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 64 * 1024 * 1024))
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Returns the 413 for oversized bodies as JSON, like every other error of this service."""
+    logger.warning("Request body exceeds MAX_CONTENT_LENGTH (%s bytes)", app.config['MAX_CONTENT_LENGTH'])
+    return jsonify({"error": f"Request body too large, the limit is {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+
+# Rendering engine: 'wkhtmltopdf' (default) or 'chromium' (headless Chromium via Playwright)
+PDF_ENGINE = os.environ.get('PDF_ENGINE', 'wkhtmltopdf')
+# Number of conversions that may run at the same time.
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+# Seconds a single conversion may take before the engine is killed and the request fails, so a hanging
+# render (e.g. JavaScript that never finishes, or a stalled remote resource) can't hold a pool slot forever.
+PDF_RENDER_TIMEOUT = int(os.environ.get('PDF_RENDER_TIMEOUT', 120))
+# Directory for temporary files: wkhtmltopdf's spool files for stdin/stdout ($TMPDIR), the page ranges
+# merged by pdfunite and the stderr of streamed conversions. Defaults to the system temp directory;
+# set PDF_TEMP_DIR=/dev/shm to keep them in RAM, but only with a large enough shm_size: Docker limits
+# /dev/shm to 64MB, shared by all concurrent conversions, which large documents exceed (ENOSPC).
+PDF_TEMP_DIR = os.environ.get('PDF_TEMP_DIR') or tempfile.gettempdir()
+# Bounds of the in-process cache of rendered PDFs (per process). PDF_CACHE_ENTRIES=0 disables it.
+PDF_CACHE_ENTRIES = int(os.environ.get('PDF_CACHE_ENTRIES', 256))
+PDF_CACHE_BYTES = int(os.environ.get('PDF_CACHE_BYTES', 64 * 1024 * 1024))
+# Optional zero-copy delivery through nginx: when PDF_ACCEL_REDIRECT_DIR is set, results are written
+# there and the response only carries an X-Accel-Redirect header pointing nginx at
+# PDF_ACCEL_REDIRECT_PREFIX + file name. Files older than PDF_ACCEL_REDIRECT_TTL seconds are deleted.
+PDF_ACCEL_REDIRECT_DIR = os.environ.get('PDF_ACCEL_REDIRECT_DIR')
+PDF_ACCEL_REDIRECT_PREFIX = os.environ.get('PDF_ACCEL_REDIRECT_PREFIX', '/internal/pdfs/')
+PDF_ACCEL_REDIRECT_TTL = int(os.environ.get('PDF_ACCEL_REDIRECT_TTL', 300))
+# Large wkhtmltopdf documents containing explicit page-break markers are split at the markers,
+# the chunks rendered in parallel on the conversion pool and merged with pdfunite.
+PAGEBREAK_MARKER = b'<!--PAGEBREAK-->'
+PAGEBREAK_HTML = b'<div style="page-break-after: always"></div>' # Replaces markers in documents that are not split
+PDF_SHARD_MIN_BYTES = int(os.environ.get('PDF_SHARD_MIN_BYTES', 512 * 1024)) # Smaller documents are rendered in one go
+XVFB_DISPLAY = ':99' # Display used for the shared Xvfb server unless DISPLAY is already set
+XVFB_SCREEN = '1024x768x24' # Screen resolution for the virtual display buffer
+XVFB_STARTUP_TIMEOUT = 10 # Seconds to wait for a freshly spawned Xvfb to accept connections
+
+_xvfb_process = None # Xvfb server started by this module, if any
+_xvfb_owner_pid = None # PID of the process that started it (forked children must not stop it)
+_xvfb_lock = threading.Lock() # Serialises relaunching the X server between the conversion threads
+
+
+def _safe_unlink(path):
+    """Deletes a file if it exists. A single unlink() instead of exists() + remove(), and no check-then-delete race."""
+    try:
+        os.unlink(path)
+    except (TypeError, FileNotFoundError):
+        pass # No path, or already removed (e.g. concurrently by another worker)
+
+
+def _x_socket_path(display):
+    """Returns the path of the X11 unix socket for a display string such as ":99"."""
+    return f"/tmp/.X11-unix/X{display.lstrip(':').split('.')[0]}"
+
+
+def _x_lock_path(display):
+    """Returns the path of the lock file the X server holds for a display string such as ":99"."""
+    return f"/tmp/.X{display.lstrip(':').split('.')[0]}-lock"
+
+
+def _x_server_alive(display):
+    """
+    Returns True if an X server accepts connections on the unix socket of `display`.
+    The socket file alone proves nothing: it survives a crashed Xvfb and a container restart.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        try:
+            sock.connect(_x_socket_path(display))
+        except OSError:
+            return False
+    return True
+
+
+def _x_lock_owner_running(display):
+    """Returns True if the lock file of `display` belongs to a live Xvfb process (e.g. one that is still starting up)."""
+    try:
+        with open(_x_lock_path(display)) as f:
+            pid = int(f.read().strip())
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except (OSError, ValueError):
+        return False
+    # /proc/<pid>/stat is "<pid> (<comm>) <state> ..."; PIDs restart from 1 in a restarted container,
+    # so a live process alone doesn't mean the lock is still held by an X server.
+    comm = stat[stat.index('(') + 1:stat.rindex(')')]
+    state = stat[stat.rindex(')') + 2:].split(' ', 1)[0]
+    return comm.startswith('Xvfb') and state != 'Z'
+
+
+def _wait_for_x_server(display, process=None):
+    """
+    Waits until the X server for `display` accepts connections.
+    Returns False if `process` (the Xvfb we spawned, if any) exits before that happens.
+    """
+    deadline = time.monotonic() + XVFB_STARTUP_TIMEOUT
+    while not _x_server_alive(display):
+        if process is not None and process.poll() is not None:
+            return False
+        if time.monotonic() > deadline:
+            if process is not None:
+                process.kill()
+            raise RuntimeError(f"X server on display {display} did not come up within {XVFB_STARTUP_TIMEOUT}s")
+        time.sleep(0.05)
+    return True
+
+
+def launch_xvfb(stop_at_exit=True):
+    """
+    Starts the single Xvfb server shared by all conversions and returns its display string.
+    If DISPLAY already points at a running X server (e.g. one started by the container
+    entrypoint or a parent process), that server is reused instead of starting another one.
+    Lock and socket files left behind by a dead server are removed first, as they would stop Xvfb from starting.
+    With stop_at_exit=False the server outlives this process (used when a worker relaunches the shared server).
+    """
+    global _xvfb_process, _xvfb_owner_pid
+    display = os.environ.get('DISPLAY') or XVFB_DISPLAY
+    if _x_server_alive(display):
+        logger.info("Reusing running X server on display %s", display)
+        return display
+    if not _x_lock_owner_running(display):
+        _safe_unlink(_x_lock_path(display))
+        _safe_unlink(_x_socket_path(display))
+
+    process = subprocess.Popen(
+        ['Xvfb', display, '-screen', '0', XVFB_SCREEN, '-nolisten', 'tcp'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if not _wait_for_x_server(display, process):
+        # Our Xvfb exited straight away because the display is already taken, typically by a
+        # server that the entrypoint or another worker started a moment earlier. Wait for it and reuse it.
+        logger.info("Xvfb exited with code %s, waiting for the X server already starting on %s", process.returncode, display)
+        _wait_for_x_server(display)
+        return display
+
+    if stop_at_exit:
+        _xvfb_process = process
+        _xvfb_owner_pid = os.getpid()
+    logger.info("Started Xvfb (pid %s) on display %s", process.pid, display)
+    return display
+
+
+def ensure_xvfb():
+    """Relaunches the shared Xvfb server if it no longer accepts connections (e.g. after it crashed)."""
+    with _xvfb_lock:
+        display = os.environ.get('DISPLAY') or XVFB_DISPLAY
+        if not _x_server_alive(display):
+            logger.warning("X server on display %s is not accepting connections, relaunching Xvfb", display)
+            launch_xvfb(stop_at_exit=False)
+
+
+@atexit.register
+def _stop_xvfb():
+    """Terminates the shared Xvfb server, but only in the process that started it."""
+    if _xvfb_process is not None and _xvfb_owner_pid == os.getpid() and _xvfb_process.poll() is None:
+        _xvfb_process.terminate()
+
+
+class ConversionError(Exception):
+    """Raised by the renderers when no PDF could be produced; carries the JSON payload for the 500 response."""
+
+    def __init__(self, payload):
+        super().__init__(payload['error'])
+        self.payload = payload
+
+
+# Command to run wkhtmltopdf
+# wkhtmltopdf needs an X display in headless environments like Docker containers.
+# The display is provided by the shared Xvfb server (see launch_xvfb),
+# so there is no per-request xvfb-run wrapper any more.
+# --encoding utf-8 tells wkhtmltopdf the input encoding (the HTML is sent UTF-8 encoded).
+# --enable-local-file-access might be needed if your HTML references local files (CSS, images).
+# The two '-' arguments make wkhtmltopdf read the HTML from stdin and write the PDF to stdout,
+# so no temporary files have to be created, written, read back and cleaned up.
+# Flags for the client-tunable render options (see RENDER_OPTIONS) go between the base command and the '-' pair.
+WKHTMLTOPDF_COMMAND = [
+    'wkhtmltopdf',
+    '--encoding', 'utf-8', # <-- ADDED: Explicitly set input encoding to UTF-8
+    '--enable-local-file-access', # Often needed if your HTML links local CSS/images
+    # '--debug-javascript', # Uncomment if you suspect JS issues related to JS rendering
+    # '--no-outline', # Example option: Removes PDF outline
+]
+WKHTMLTOPDF_IO = [
+    '-', # Read the HTML from stdin
+    '-', # Write the PDF to stdout
+]
+
+
+def _bounded_int(low, high):
+    """Returns a validator accepting integers in [low, high]."""
+    def validate(value):
+        if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            raise ValueError(f"must be an integer between {low} and {high}")
+        return value
+    return validate
+
+
+def _boolean(value):
+    """Validator accepting true/false."""
+    if not isinstance(value, bool):
+        raise ValueError("must be true or false")
+    return value
+
+
+def _matching(pattern, description):
+    """Returns a validator accepting strings that fully match `pattern`."""
+    regex = re.compile(pattern)
+    def validate(value):
+        if not isinstance(value, str) or not regex.fullmatch(value):
+            raise ValueError(f"must be {description}")
+        return value
+    return validate
+
+
+_margin = _matching(r'\d+(\.\d+)?(mm|cm|in|px)?', 'a length such as "10mm"')
+
+# Whitelist of render options clients may pass as "opts" in the JSON body: name -> validator.
+# For wkhtmltopdf every option maps to the flag of the same name (e.g. image_quality -> --image-quality);
+# booleans map to the enable/disable pair of the flag.
+# Two of them are accepted for compatibility but have no effect in the Docker image: `dpi` is ignored on
+# X11 (wkhtmltopdf always renders under Xvfb here), and `smart_shrinking` needs a wkhtmltopdf built
+# against patched Qt, which the Debian package is not (it only prints a warning).
+RENDER_OPTIONS = {
+    'dpi': _bounded_int(1, 1200),
+    'image_dpi': _bounded_int(1, 1200),
+    'image_quality': _bounded_int(1, 100),
+    'lowquality': _boolean,
+    'grayscale': _boolean,
+    'smart_shrinking': _boolean,
+    'javascript': _boolean,
+    'javascript_delay': _bounded_int(0, 30000),
+    'images': _boolean,
+    'page_size': _matching(r'[A-Za-z0-9]+', 'a page size name such as "A4" or "Letter"'),
+    'orientation': _matching(r'Portrait|Landscape', '"Portrait" or "Landscape"'),
+    'margin_top': _margin,
+    'margin_bottom': _margin,
+    'margin_left': _margin,
+    'margin_right': _margin,
+}
+
+# Default options, tuned for rendering speed and output size: --lowquality prints at screen resolution,
+# images are re-encoded at JPEG quality 75, and JavaScript execution is one of the most expensive parts of a render.
+# Clients opt back in per request (e.g. {"javascript": true, "lowquality": false}), or pass null to fall back
+# to the engine default. PDF_FAST_DEFAULTS=0 makes the engine defaults the service defaults.
+FAST_RENDER_OPTIONS = {
+    'lowquality': True,
+    'image_quality': 75,
+    'javascript': False,
+}
+DEFAULT_RENDER_OPTIONS = FAST_RENDER_OPTIONS if os.environ.get('PDF_FAST_DEFAULTS', '1') != '0' else {}
+
+# wkhtmltopdf flag pairs for boolean options: (flag when true, flag when false). None means "no flag".
+_WKHTMLTOPDF_SWITCHES = {
+    'lowquality': ('--lowquality', None),
+    'grayscale': ('--grayscale', None),
+    'smart_shrinking': ('--enable-smart-shrinking', '--disable-smart-shrinking'),
+    'javascript': ('--enable-javascript', '--disable-javascript'),
+    'images': ('--images', '--no-images'),
+}
+
+
+def parse_render_options(opts):
+    """
+    Validates client supplied options against RENDER_OPTIONS and merges them over the defaults.
+    Returns the effective options dict; raises ValueError with a client-facing message if invalid.
+    """
+    if opts is None:
+        opts = {}
+    if not isinstance(opts, dict):
+        raise ValueError("'opts' must be an object")
+    unknown = sorted(set(opts) - set(RENDER_OPTIONS))
+    if unknown:
+        raise ValueError(f"Unsupported option(s): {', '.join(unknown)}")
+
+    options = dict(DEFAULT_RENDER_OPTIONS)
+    for name, value in opts.items():
+        if value is None:
+            options.pop(name, None) # Use the engine default
+            continue
+        try:
+            options[name] = RENDER_OPTIONS[name](value)
+        except ValueError as e:
+            raise ValueError(f"Option '{name}' {e}")
+    return options
+
+
+def _wkhtmltopdf_flags(options):
+    """Translates render options into wkhtmltopdf command line flags."""
+    flags = []
+    for name, value in sorted(options.items()):
+        if name in _WKHTMLTOPDF_SWITCHES:
+            flag = _WKHTMLTOPDF_SWITCHES[name][0 if value else 1]
+            if flag:
+                flags.append(flag)
+        else:
+            flags += ['--' + name.replace('_', '-'), str(value)]
+    return flags
+
+
+def _timeout_error():
+    """Returns the ConversionError for a conversion that was killed after PDF_RENDER_TIMEOUT."""
+    logger.error("PDF conversion did not finish within %ss and was killed", PDF_RENDER_TIMEOUT)
+    return ConversionError({
+        "error": f"PDF conversion timed out after {PDF_RENDER_TIMEOUT}s",
+    })
+
+
+def _run_wkhtmltopdf(command, html_bytes):
+    """Runs a buffered wkhtmltopdf command, killing it after PDF_RENDER_TIMEOUT (raises ConversionError then)."""
+    try:
+        return subprocess.run(command, input=html_bytes, capture_output=True, env=WKHTMLTOPDF_ENV, timeout=PDF_RENDER_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise _timeout_error() # subprocess.run has already killed and reaped wkhtmltopdf
+
+
+def _render_with_wkhtmltopdf(html_bytes, options):
+    """
+    Runs inside a pool worker: executes wkhtmltopdf against the shared display,
+    feeding the HTML through stdin, and returns the PDF bytes read from stdout.
+    """
+    command = WKHTMLTOPDF_COMMAND + _wkhtmltopdf_flags(options) + WKHTMLTOPDF_IO
+    logger.debug("Running command: %s", command)
+
+    # capture_output=True captures stdout/stderr of the subprocess as raw bytes (no text decoding),
+    # because stdout *is* the PDF. stderr (progress and error messages, often tens of KB) is only
+    # decoded when it is actually needed: on failure, or when DEBUG logging is enabled.
+    result = _run_wkhtmltopdf(command, html_bytes)
+    if result.returncode not in [0, 1] and _lost_x_server(result.stderr):
+        # The shared Xvfb is gone (crashed or killed); bring it back and try once more
+        ensure_xvfb()
+        result = _run_wkhtmltopdf(command, html_bytes)
+    pdf_bytes = result.stdout
+
+    logger.debug("Command finished with return code %s, produced %d bytes of PDF output", result.returncode, len(pdf_bytes))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("wkhtmltopdf STDERR:\n%s", result.stderr.decode('utf-8', 'replace'))
+
+    _check_wkhtmltopdf_result(result.returncode, bool(pdf_bytes), result.stderr)
+    return pdf_bytes
+
+
+# What wkhtmltopdf (Qt) prints when it cannot reach the X server on DISPLAY
+_X_CONNECT_ERROR = re.compile(rb'connect to (X server|display)', re.IGNORECASE)
+
+
+def _lost_x_server(stderr_bytes):
+    """Returns True if a failed wkhtmltopdf run reported that it could not connect to the X server."""
+    return _X_CONNECT_ERROR.search(stderr_bytes) is not None
+
+
+def _check_wkhtmltopdf_result(returncode, produced_output, stderr_bytes):
+    """Raises ConversionError (with details from wkhtmltopdf's stderr) if a wkhtmltopdf run did not produce a PDF."""
+    # Check if the conversion was successful (wkhtmltopdf typically returns 0 on success)
+    # Note: wkhtmltopdf sometimes returns 1 for warnings that don't prevent PDF generation
+    if returncode not in [0, 1]:
+        stderr = stderr_bytes.decode('utf-8', 'replace')
+        logger.error("PDF conversion failed with return code %s:\n%s", returncode, stderr)
+        # Details from wkhtmltopdf's stderr are returned to the client
+        raise ConversionError({
+            "error": "PDF conversion failed",
+            "details": stderr,
+        })
+
+    # Check if the PDF output was actually produced
+    if not produced_output:
+        logger.error("PDF conversion command succeeded, but produced no output")
+        raise ConversionError({
+            "error": "PDF conversion command succeeded, but output is empty",
+            "command_output_stderr": stderr_bytes.decode('utf-8', 'replace'),
+        })
+
+
+STREAM_CHUNK_SIZE = 64 * 1024 # Bytes forwarded per chunk when streaming wkhtmltopdf's output
+STREAM_QUEUE_CHUNKS = 4 # Chunks buffered between the pool worker and the response, capping memory per stream
+
+
+def _put_chunk(chunks, item, cancelled, deadline):
+    """
+    Hands an item to the streaming response, giving up once the response has been closed.
+    A client that stops reading without closing the connection would block this forever, so past
+    `deadline` (a time.monotonic() value) the stream is cancelled instead.
+    """
+    while not cancelled.is_set():
+        if time.monotonic() > deadline:
+            logger.warning("Client stopped reading the PDF stream, cancelling the conversion after %ss", PDF_RENDER_TIMEOUT)
+            cancelled.set()
+            return
+        try:
+            chunks.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def _stream_with_wkhtmltopdf(html_bytes, options, chunks, cancelled):
+    """
+    Runs inside a pool worker: pipes the HTML into wkhtmltopdf and forwards its stdout to the `chunks`
+    queue in STREAM_CHUNK_SIZE pieces, followed by a final (returncode, stderr bytes) tuple.
+    The pool slot stays taken until the stream is done, so streaming respects PDF_WORKERS like any render.
+    If `cancelled` is set (the client went away, or stopped reading for longer than PDF_RENDER_TIMEOUT),
+    wkhtmltopdf is killed. It is also killed if the stream is not done after PDF_RENDER_TIMEOUT, which raises ConversionError.
+    """
+    deadline = time.monotonic() + PDF_RENDER_TIMEOUT
+    command = WKHTMLTOPDF_COMMAND + _wkhtmltopdf_flags(options) + WKHTMLTOPDF_IO
+    logger.debug("Running command (streaming): %s", command)
+    html_bytes = _with_page_breaks(html_bytes)
+
+    # stderr goes to an unnamed temp file instead of a pipe, so wkhtmltopdf never blocks on a full stderr
+    # pipe while we are only draining stdout.
+    with tempfile.TemporaryFile(dir=PDF_TEMP_DIR) as stderr_file:
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file, env=WKHTMLTOPDF_ENV
+        )
+        # Killing the process also unblocks the reads below, so one timer bounds the whole stream
+        timed_out = threading.Event()
+        def kill_on_timeout():
+            timed_out.set()
+            process.kill()
+        killer = threading.Timer(PDF_RENDER_TIMEOUT, kill_on_timeout)
+        killer.start()
+        try:
+            # wkhtmltopdf reads all of stdin before it starts writing output, so writing everything first can't deadlock
+            try:
+                process.stdin.write(html_bytes)
+                process.stdin.close()
+            except BrokenPipeError:
+                pass # wkhtmltopdf exited early; its stderr tells why
+            while not cancelled.is_set():
+                chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                _put_chunk(chunks, chunk, cancelled, deadline)
+        finally:
+            if cancelled.is_set():
+                process.kill()
+            process.stdout.close()
+            returncode = process.wait()
+            killer.cancel()
+        if timed_out.is_set() and returncode < 0: # Killed by the timer, not finished just before it fired
+            raise _timeout_error()
+        stderr_file.seek(0)
+        stderr_bytes = stderr_file.read()
+
+    logger.debug("Streaming command finished with return code %s", returncode)
+    if returncode not in [0, 1] and _lost_x_server(stderr_bytes):
+        ensure_xvfb() # This stream has failed already, but the next conversion gets a working display again
+    _put_chunk(chunks, (returncode, stderr_bytes), cancelled, deadline)
+
+
+def _close_chromium():
+    """Closes and forgets the worker thread's browser and Playwright driver, so the next conversion relaunches them."""
+    browser = getattr(_worker_state, 'browser', None)
+    playwright = getattr(_worker_state, 'playwright', None)
+    _worker_state.browser = _worker_state.playwright = None
+    try:
+        if browser is not None:
+            browser.close()
+        if playwright is not None:
+            playwright.stop()
+    except Exception as e:
+        logger.debug("Ignoring error while closing Chromium: %s", e) # The browser is usually dead already
+
+
+def _chromium_browser():
+    """Returns the worker thread's Chromium, launching it if there is none yet or the previous one has died."""
+    browser = getattr(_worker_state, 'browser', None)
+    if browser is not None and not browser.is_connected():
+        logger.warning("Chromium of PDF worker %s is gone (crashed or killed), relaunching it", threading.current_thread().name)
+        _close_chromium()
+        browser = None
+    if browser is None:
+        # Playwright's sync API objects are bound to the thread that created them,
+        # so every worker thread starts its own driver and browser.
+        _worker_state.playwright = sync_playwright().start()
+        browser = _worker_state.playwright.chromium.launch(args=['--no-sandbox', '--disable-dev-shm-usage'])
+        _worker_state.browser = browser
+        logger.info("PDF worker %s launched Chromium %s", threading.current_thread().name, browser.version)
+    return browser
+
+
+def _render_with_chromium(html_bytes, options):
+    """
+    Runs inside a pool worker: renders the HTML with headless Chromium via Playwright.
+    Every worker thread launches its browser once and reuses it for all later conversions;
+    each conversion gets a fresh, isolated browser context.
+    Honours the page layout options and `javascript`; the wkhtmltopdf specific quality options are ignored.
+    """
+    margins = {side: options[f'margin_{side}'] for side in ('top', 'bottom', 'left', 'right') if f'margin_{side}' in options}
+    try:
+        context = _chromium_browser().new_context(java_script_enabled=options.get('javascript', True))
+        try:
+            page = context.new_page()
+            page.set_default_timeout(PDF_RENDER_TIMEOUT * 1000) # Playwright timeouts are in milliseconds
+            page.set_content(html_bytes.decode('utf-8', 'replace'))
+            # print_background matches wkhtmltopdf, which prints background colours and images by default
+            pdf_bytes = page.pdf(
+                print_background=True,
+                format=options.get('page_size', 'A4'),
+                landscape=options.get('orientation') == 'Landscape',
+                margin=margins or None,
+            )
+        finally:
+            context.close()
+    except Exception as e:
+        # A timed out page leaves the browser usable; after any other failure (e.g. a crashed or OOM-killed
+        # browser) it is dropped, so a dead browser can't fail every later conversion on this thread.
+        if not isinstance(e, PlaywrightTimeoutError):
+            _close_chromium()
+        raise ConversionError({
+            "error": "PDF conversion failed",
+            "details": str(e),
+        })
+
+    logger.debug("Chromium produced %d bytes of PDF output", len(pdf_bytes))
+    return pdf_bytes
+
+
+# Rendering engines selectable via PDF_ENGINE
+_RENDERERS = {
+    'wkhtmltopdf': _render_with_wkhtmltopdf,
+    'chromium': _render_with_chromium,
+}
+if PDF_ENGINE not in _RENDERERS:
+    raise RuntimeError(f"Unknown PDF_ENGINE {PDF_ENGINE!r}, expected one of: {', '.join(_RENDERERS)}")
+if PDF_ENGINE == 'chromium':
+    # Playwright is an optional dependency, only installed in images built with INSTALL_CHROMIUM=true.
+    # Import it here so a missing installation fails at startup instead of on the first request.
+    from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+
+
+class PdfCache:
+    """
+    Thread-safe LRU cache of rendered PDFs, keyed by a hash of the HTML.
+    Bounded both by the number of entries and by the total size of the cached PDFs.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(html_bytes, options):
+        """
+        Returns the cache key for a document rendered with the given options
+        (blake2b hashes at roughly 1GB/s per core).
+        """
+        digest = hashlib.blake2b(repr(sorted(options.items())).encode('utf-8'), digest_size=16)
+        digest.update(html_bytes)
+        return digest.digest()
+
+    def get(self, key):
+        """Returns the cached PDF bytes for `key` (marking them most recently used), or None."""
+        with self._lock:
+            pdf_bytes = self._entries.get(key)
+            if pdf_bytes is not None:
+                self._entries.move_to_end(key)
+            return pdf_bytes
+
+    def put(self, key, pdf_bytes):
+        """Stores a PDF, evicting the least recently used entries until both bounds are met again."""
+        if self.max_entries <= 0 or len(pdf_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = pdf_bytes
+            self._size += len(pdf_bytes)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+def _with_page_breaks(html_bytes):
+    """
+    Turns page-break markers into forced page breaks, so a marker paginates the same whether or not
+    the document is split at it (small documents, batch documents, streaming and Chromium are not).
+    """
+    if PAGEBREAK_MARKER not in html_bytes:
+        return html_bytes
+    return html_bytes.replace(PAGEBREAK_MARKER, PAGEBREAK_HTML)
+
+
+def _render(html_bytes, options):
+    """Runs inside a pool worker: renders a document with the configured engine."""
+    return _RENDERERS[PDF_ENGINE](_with_page_breaks(html_bytes), options)
+
+
+def _render_and_cache(html_bytes, options, cache_key):
+    """Runs inside a pool worker: renders with the configured engine and caches the result."""
+    pdf_bytes = _render(html_bytes, options)
+    pdf_cache.put(cache_key, pdf_bytes)
+    return pdf_bytes
+
+
+def _cache_lookup(html_bytes, options, use_cache):
+    """
+    Looks a document up in the PDF cache. Returns (cache_key, pdf_bytes): pdf_bytes is None on a miss,
+    and cache_key is None too if the cache is bypassed (use_cache False) or disabled.
+    """
+    if not use_cache or pdf_cache.max_entries <= 0:
+        return None, None
+    cache_key = PdfCache.key(html_bytes, options)
+    pdf_bytes = pdf_cache.get(cache_key)
+    if pdf_bytes is not None:
+        logger.debug("PDF cache hit for %s", cache_key.hex())
+    return cache_key, pdf_bytes
+
+
+def submit_render(html_bytes, options=None, use_cache=True):
+    """
+    Queues UTF-8 encoded HTML for rendering with the configured engine on the conversion pool.
+    `options` are render options as returned by parse_render_options (defaults if None).
+    Returns a Future whose result() is the PDF bytes or raises ConversionError.
+    Documents rendered before are answered from the PDF cache without touching the pool,
+    unless use_cache is False.
+    """
+    if options is None:
+        options = dict(DEFAULT_RENDER_OPTIONS)
+    cache_key, pdf_bytes = _cache_lookup(html_bytes, options, use_cache)
+    if cache_key is None:
+        return conversion_pool.submit(_render, html_bytes, options)
+    if pdf_bytes is None:
+        return conversion_pool.submit(_render_and_cache, html_bytes, options, cache_key)
+
+    future = Future()
+    future.set_result(pdf_bytes)
+    return future
+
+
+_BODY_OPEN = re.compile(rb'<body\b[^>]*>', re.IGNORECASE)
+_BODY_CLOSE = re.compile(rb'</body\s*>', re.IGNORECASE)
+
+
+def _split_pages(html_bytes):
+    """
+    Splits a document at PAGEBREAK_MARKER into standalone chunks. Every chunk gets the document's
+    head (everything up to and including <body ...>) and its tail (from </body> on), so styles apply to all of them.
+    Elements opened before a marker are not closed/reopened around it, so markers belong at the top level of <body>.
+    Returns a list with the chunks, or just the document itself if it contains no markers.
+    """
+    if PAGEBREAK_MARKER not in html_bytes:
+        return [html_bytes]
+
+    body_open = _BODY_OPEN.search(html_bytes)
+    body_start = body_open.end() if body_open else 0
+    body_close = None
+    for body_close in _BODY_CLOSE.finditer(html_bytes, body_start):
+        pass # Keep the last match
+    body_end = body_close.start() if body_close else len(html_bytes)
+    head, body, tail = html_bytes[:body_start], html_bytes[body_start:body_end], html_bytes[body_end:]
+    return [head + part + tail for part in body.split(PAGEBREAK_MARKER) if part.strip()]
+
+
+def _merge_pdfs(parts):
+    """Runs inside a pool worker: concatenates PDF documents with pdfunite and returns the merged PDF bytes."""
+    part_paths = []
+    merged_path = os.path.join(PDF_TEMP_DIR, f"{uuid.uuid4().hex}-merged.pdf")
+    try:
+        for part in parts:
+            fd, path = tempfile.mkstemp(suffix='.pdf', dir=PDF_TEMP_DIR)
+            part_paths.append(path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(part)
+
+        try:
+            result = subprocess.run(['pdfunite', *part_paths, merged_path], capture_output=True, timeout=PDF_RENDER_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise _timeout_error()
+        if result.returncode != 0:
+            stderr = result.stderr.decode('utf-8', 'replace')
+            logger.error("pdfunite failed with return code %s:\n%s", result.returncode, stderr)
+            raise ConversionError({
+                "error": "Merging the rendered page ranges failed",
+                "details": stderr,
+            })
+        with open(merged_path, 'rb') as f:
+            return f.read()
+    finally:
+        for path in part_paths:
+            _safe_unlink(path)
+        _safe_unlink(merged_path)
+
+
+def _render_sharded(chunks, options):
+    """Renders the chunks of a split document in parallel on the conversion pool and merges the results."""
+    futures = [conversion_pool.submit(_render, chunk, options) for chunk in chunks]
+    try:
+        parts = [future.result() for future in futures]
+    except ConversionError:
+        for future in futures:
+            future.cancel()
+        raise
+    return conversion_pool.submit(_merge_pdfs, parts).result()
+
+
+def render_pdf(html_bytes, options=None, use_cache=True):
+    """
+    Renders UTF-8 encoded HTML with the configured engine on the conversion pool and returns the PDF bytes.
+    Large wkhtmltopdf documents with page-break markers are rendered as parallel page ranges (see _split_pages).
+    Raises ConversionError if the engine could not produce a PDF.
+    """
+    chunks = None
+    if PDF_ENGINE == 'wkhtmltopdf' and len(html_bytes) >= PDF_SHARD_MIN_BYTES:
+        chunks = _split_pages(html_bytes)
+    if not chunks or len(chunks) < 2:
+        return submit_render(html_bytes, options, use_cache).result()
+
+    if options is None:
+        options = dict(DEFAULT_RENDER_OPTIONS)
+    cache_key, pdf_bytes = _cache_lookup(html_bytes, options, use_cache)
+    if pdf_bytes is not None:
+        return pdf_bytes
+
+    logger.debug("Rendering %d page ranges in parallel", len(chunks))
+    pdf_bytes = _render_sharded(chunks, options)
+    if cache_key is not None:
+        pdf_cache.put(cache_key, pdf_bytes)
+    return pdf_bytes
+
+
+def _json_body():
+    """
+    Parses a JSON request body with orjson, which is several times faster than the stdlib json module
+    used by request.get_json() on large HTML-in-JSON payloads.
+    Returns None if the request is not JSON or the body is not valid JSON, like get_json(silent=True).
+    """
+    if not request.is_json:
+        return None
+    try:
+        return orjson.loads(request.get_data())
+    except orjson.JSONDecodeError as e:
+        logger.warning("Request body is not valid JSON: %s", e)
+        return None
+
+
+def _query_flag(name):
+    """Returns True if the query parameter `name` is set to 1/true/yes."""
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _cache_requested():
+    """Returns False if the client asked to bypass the PDF cache with ?nocache=1."""
+    return not _query_flag('nocache')
+
+
+def _next_chunk(chunks, job):
+    """Waits for the next item from a streaming job, re-raising the job's exception if it died."""
+    while True:
+        try:
+            return chunks.get(timeout=1)
+        except queue.Empty:
+            if job.done():
+                try:
+                    # The job may have put its last item between the get() above and the done() check
+                    return chunks.get_nowait()
+                except queue.Empty:
+                    pass
+                job.result() # Raises the pool worker's exception, if any
+                raise RuntimeError("Streaming conversion ended without a result")
+
+
+def _stream_pdf_response(html_bytes, options):
+    """
+    Starts a streaming wkhtmltopdf conversion and returns a chunked response that forwards the PDF
+    as it is read from wkhtmltopdf's stdout, so the service holds at most a few chunks of it in memory.
+    Waits for the first chunk before responding, so failures that produce no output still get a JSON 500.
+    """
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    job = conversion_pool.submit(_stream_with_wkhtmltopdf, html_bytes, options, chunks, cancelled)
+
+    first = _next_chunk(chunks, job)
+    if isinstance(first, tuple):
+        returncode, stderr_bytes = first
+        _check_wkhtmltopdf_result(returncode, False, stderr_bytes) # Always raises ConversionError here
+
+    def generate():
+        try:
+            yield first
+            while True:
+                item = _next_chunk(chunks, job)
+                if isinstance(item, tuple):
+                    returncode, stderr_bytes = item
+                    if returncode not in [0, 1]:
+                        # The status line is already sent; all we can do is log it
+                        logger.error("Streaming PDF conversion failed with return code %s after the response started:\n%s",
+                                     returncode, stderr_bytes.decode('utf-8', 'replace'))
+                    return
+                yield item
+        finally:
+            # Also runs when the client disconnects: stops the pool worker and kills wkhtmltopdf
+            cancelled.set()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/pdf',
+        headers={'Content-Disposition': 'attachment; filename=converted.pdf'}
+    )
+
+
+# wkhtmltopdf needs an X display; start (or reuse) the shared server once at import time,
+# so no request pays the Xvfb startup cost. Exporting DISPLAY lets processes forked
+# from this one reuse the same server. Chromium runs headless and needs no display.
+if PDF_ENGINE == 'wkhtmltopdf':
+    os.environ['DISPLAY'] = launch_xvfb()
+# Fixed fontconfig configuration and a writable cache location, so every wkhtmltopdf run reuses
+# the font cache built at image build time (fc-cache) instead of rescanning the font directories.
+os.environ.setdefault('FONTCONFIG_PATH', '/etc/fonts')
+os.environ.setdefault('XDG_CACHE_HOME', os.path.join(tempfile.gettempdir(), 'n8n-pdf-cache'))
+WKHTMLTOPDF_ENV = dict(os.environ, TMPDIR=PDF_TEMP_DIR) # Environment passed to every wkhtmltopdf invocation
+
+# Pool of conversion workers, bounding the number of concurrent conversions.
+# Threads are sufficient here: the heavy lifting happens in the wkhtmltopdf subprocess
+# (or the Chromium browser process), the worker thread only waits for it to finish.
+conversion_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix='pdf-worker')
+_worker_state = threading.local() # Per-worker state, e.g. the worker's Chromium browser
+pdf_cache = PdfCache(PDF_CACHE_ENTRIES, PDF_CACHE_BYTES)
+
+
+def _reset_after_fork():
+    """
+    Runs in every process forked from this one (e.g. Gunicorn workers with preload_app).
+    Threads don't survive fork(), so the pool, the per-thread state, the cache and the locks
+    inherited from the parent are replaced by fresh ones. Module-level configuration, the shared
+    Xvfb and everything imported stay shared copy-on-write.
+    """
+    global conversion_pool, _worker_state, pdf_cache, _xvfb_lock
+    conversion_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix='pdf-worker')
+    _worker_state = threading.local()
+    _xvfb_lock = threading.Lock()
+    pdf_cache = PdfCache(PDF_CACHE_ENTRIES, PDF_CACHE_BYTES)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _log_warmup_result(future):
+    """Done-callback of the warm-up render: a failure there is logged, but does not stop the service."""
+    try:
+        future.result()
+        logger.info("Warm-up conversion finished")
+    except Exception as e:
+        logger.warning("Warm-up conversion failed: %s", e)
+
+
+def warm_up():
+    """
+    Renders a tiny document in the background so the first real request doesn't pay for loading
+    the engine, its libraries and the font cache from disk.
+    """
+    conversion_pool.submit(
+        _RENDERERS[PDF_ENGINE], b'<html><body><p>warm-up</p></body></html>', dict(DEFAULT_RENDER_OPTIONS)
+    ).add_done_callback(_log_warmup_result)
+
+
+# Warm up once at startup; disable with PDF_WARMUP=0. (The Gunicorn config disables this for the
+# preloading master and calls warm_up() in each worker after the fork instead.)
+if os.environ.get('PDF_WARMUP', '1') != '0':
+    warm_up()
+
+
+def _accel_redirect_janitor():
+    """Background thread: deletes X-Accel-Redirect result files once they are older than the TTL."""
+    while True:
+        time.sleep(max(1, PDF_ACCEL_REDIRECT_TTL // 2))
+        cutoff = time.time() - PDF_ACCEL_REDIRECT_TTL
+        try:
+            with os.scandir(PDF_ACCEL_REDIRECT_DIR) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < cutoff:
+                            _safe_unlink(entry.path)
+                    except FileNotFoundError:
+                        pass # Removed concurrently (e.g. by another worker's janitor)
+        except OSError as e:
+            logger.warning("Could not clean up %s: %s", PDF_ACCEL_REDIRECT_DIR, e)
+
+
+# With Gunicorn's preload_app this thread only runs in the master, which is enough: it cleans up the
+# directory shared by all workers.
+if PDF_ACCEL_REDIRECT_DIR:
+    os.makedirs(PDF_ACCEL_REDIRECT_DIR, exist_ok=True)
+    threading.Thread(target=_accel_redirect_janitor, name='accel-redirect-janitor', daemon=True).start()
+
+
+def _file_response(body, mimetype, filename):
+    """
+    Builds the response for a finished result (PDF or ZIP).
+    By default the bytes are returned directly. With PDF_ACCEL_REDIRECT_DIR set, they are written to that
+    directory instead and nginx is told to serve the file itself via X-Accel-Redirect (sendfile),
+    so the payload doesn't travel through Python/WSGI to the socket.
+    """
+    # The Content-Disposition header suggests a download filename, though n8n consumes the binary data directly.
+    headers = {'Content-Disposition': f'attachment; filename={filename}'}
+    if not PDF_ACCEL_REDIRECT_DIR:
+        return Response(body, mimetype=mimetype, headers=headers)
+
+    name = f"{uuid.uuid4().hex}{os.path.splitext(filename)[1]}"
+    path = os.path.join(PDF_ACCEL_REDIRECT_DIR, name)
+    try:
+        with open(path, 'xb') as f:
+            f.write(body)
+    except OSError:
+        # Don't leave a truncated file behind for nginx (e.g. when the volume is full)
+        _safe_unlink(path)
+        raise
+    logger.debug("Handing %s (%d bytes) to nginx via X-Accel-Redirect", name, len(body))
+    # nginx keeps Content-Type and Content-Disposition of this response when it serves the file
+    headers['X-Accel-Redirect'] = PDF_ACCEL_REDIRECT_PREFIX + name
+    return Response(b'', mimetype=mimetype, headers=headers)
 
 @app.route('/convert', methods=['POST'])
 def convert_html_to_pdf():
     """
-    Receives HTML content via POST request, converts it to PDF using wkhtmltopdf,
-    and returns the PDF binary data.
-    Expects JSON body: {"html": "<div>...</div>"}
+    Receives HTML content via POST request, converts it to PDF using the configured engine
+    (wkhtmltopdf by default, see PDF_ENGINE), and returns the PDF binary data.
+    Expects JSON body: {"html": "<div>...</div>", "opts": {"lowquality": false, ...}} ("opts" is optional, see RENDER_OPTIONS)
+    or the raw HTML document as body with Content-Type: text/html (rendered with the default options).
+    Identical documents are served from the PDF cache; add ?nocache=1 to force a fresh render.
+    With ?stream=1 the PDF is streamed from wkhtmltopdf as a chunked response (bypassing cache and page-range splitting).
     Returns: PDF file binary data (application/pdf) or JSON error message.
     """
-    print("Received POST request to /convert")
-    sys.stdout.flush() # Force immediate flushing of print statements
-
-    temp_html_file_path = None
-    temp_pdf_file_path = None
+    logger.debug("Received POST request to /convert")
 
     try:
-        # Get JSON data from the request body
-        data = request.get_json()
-        if not data or 'html' not in data:
-            print("Error: Invalid request body, JSON with 'html' key is required.")
-            sys.stdout.flush()
-            return jsonify({"error": "Invalid request, JSON body with 'html' key is required"}), 400
-
-        # Extract HTML content
-        html_content = data.get('html')
-        if not html_content:
-            print("Error: 'html' key is present but value is empty or null.")
-            sys.stdout.flush()
-            return jsonify({"error": "'html' key is present but value is empty or null"}), 400
-
-        # Print a snippet of the received HTML for debugging
-        print(f"Received HTML content (first 200 chars): {html_content[:200]}...")
-        sys.stdout.flush()
-
-        # Create secure temporary files for HTML input and PDF output
-        # mkstemp returns a file descriptor (int) and a path (str).
-        # We need the path, so we close the descriptor immediately after getting it.
-        temp_html_fd, temp_html_file_path = tempfile.mkstemp(suffix=".html")
-        os.close(temp_html_fd) # Close the descriptor as we'll use the path with subprocess
-        temp_pdf_fd, temp_pdf_file_path = tempfile.mkstemp(suffix=".pdf")
-        os.close(temp_pdf_fd) # Close the descriptor
-
-        print(f"Created temp files: {temp_html_file_path}, {temp_pdf_file_path}")
-        sys.stdout.flush()
-
-        # Write the received HTML content to the temporary HTML file
-        # Specify utf-8 encoding to match the input HTML
-        with open(temp_html_file_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        print(f"Wrote HTML to {temp_html_file_path}")
-        sys.stdout.flush()
-
-        # Command to run wkhtmltopdf
-        # xvfb-run is used to run wkhtmltopdf in a virtual display buffer,
-        # which is necessary in headless environments like Docker containers.
-        # --auto-servernum and --server-args configure xvfb.
-        # --encoding utf-8 tells wkhtmltopdf the input file encoding.
-        # --enable-local-file-access might be needed if your HTML references local files (CSS, images).
-        command = [
-            'xvfb-run', # Run in a virtual display buffer
-            '--auto-servernum', # Automatically assign a server number
-            '--server-args="-screen 0, 1024x768x24"', # Set screen resolution for xvfb
-            'wkhtmltopdf',
-            '--encoding', 'utf-8', # <-- ADDED: Explicitly set input encoding to UTF-8
-            '--enable-local-file-access', # Often needed if your HTML links local CSS/images
-            # '--debug-javascript', # Uncomment if you suspect JS issues related to JS rendering
-            # '--no-outline', # Example option: Removes PDF outline
-            # '--page-size', 'A4', # Example option: Set page size
-            # '--margin-top', '10mm', # Example option: Set margins
-            temp_html_file_path, # Input HTML file path (the temporary file we created)
-            temp_pdf_file_path   # Output PDF file path (the temporary file for the result)
-        ]
+        opts = None
+        if request.mimetype == 'text/html':
+            # Raw HTML body: passed to the engine as-is, which skips JSON parsing, unescaping
+            # and re-encoding of (potentially very large) documents.
+            html_bytes = request.get_data()
+            charset = request.mimetype_params.get('charset', 'utf-8')
+            try:
+                is_utf8 = codecs.lookup(charset).name == 'utf-8'
+            except LookupError:
+                logger.warning("Unsupported charset %r in text/html request", charset)
+                return jsonify({"error": f"Unsupported charset: {charset}"}), 400
+            if not is_utf8:
+                # wkhtmltopdf is told the input is UTF-8, so transcode other charsets first
+                html_bytes = html_bytes.decode(charset, 'replace').encode('utf-8')
+            if not html_bytes:
+                logger.warning("text/html request body is empty")
+                return jsonify({"error": "Request body with HTML content is required"}), 400
+        else:
+            # Get JSON data from the request body
+            data = _json_body()
+            if not isinstance(data, dict) or 'html' not in data:
+                logger.warning("Invalid request body, JSON with 'html' key is required")
+                return jsonify({"error": "Invalid request, JSON body with 'html' key is required"}), 400
+
+            # Extract HTML content
+            html_content = data.get('html')
+            if not html_content:
+                logger.warning("'html' key is present but value is empty or null")
+                return jsonify({"error": "'html' key is present but value is empty or null"}), 400
+            if not isinstance(html_content, str):
+                logger.warning("'html' value is not a string")
+                return jsonify({"error": "'html' value must be a string"}), 400
+            html_bytes = html_content.encode('utf-8')
+            opts = data.get('opts')
 
-        print(f"Running command: {' '.join(command)}")
-        sys.stdout.flush()
-
-        # Execute the wkhtmltopdf command
-        # capture_output=True captures stdout/stderr of the subprocess.
-        # text=True decodes stdout/stderr as text (using default encoding, but wkhtmltopdf errors are usually ASCII).
-        result = subprocess.run(command, capture_output=True, text=True)
-
-        print(f"Command finished with return code: {result.returncode}")
-        sys.stdout.flush()
-        print("wkhtmltopdf STDOUT:\n", result.stdout)
-        sys.stdout.flush()
-        print("wkhtmltopdf STDERR:\n", result.stderr)
-        sys.stdout.flush()
-
-        # Check if the conversion was successful (wkhtmltopdf typically returns 0 on success)
-        # Note: wkhtmltopdf sometimes returns 1 for warnings that don't prevent PDF generation
-        if result.returncode not in [0, 1]:
-            print(f"PDF conversion failed with return code {result.returncode}.")
-            sys.stdout.flush()
-            # Return a 500 response with details from wkhtmltopdf's stderr and stdout
-            return jsonify({
-                "error": "PDF conversion failed",
-                "details": result.stderr,
-                "command_output": result.stdout # Include stdout too for completeness
-            }), 500
-
-        # Check if the PDF output file was actually created and is not empty
-        if not os.path.exists(temp_pdf_file_path) or os.path.getsize(temp_pdf_file_path) == 0:
-             print("PDF conversion command succeeded (return code 0), but output file was not created or is empty.")
-             sys.stdout.flush()
-             return jsonify({
-                "error": "PDF conversion command succeeded, but output file is missing or empty",
-                "details": f"Output file path: {temp_pdf_file_path}",
-                "command_output_stderr": result.stderr,
-                "command_output_stdout": result.stdout
-             }), 500
-
-        # If successful, read the generated PDF file and send it back in the HTTP response
-        print(f"Reading PDF from {temp_pdf_file_path} for sending.")
-        sys.stdout.flush()
-        # send_file is a Flask utility that efficiently streams the file content.
+        try:
+            options = parse_render_options(opts)
+        except ValueError as e:
+            logger.warning("Invalid render options: %s", e)
+            return jsonify({"error": f"Invalid opts: {e}"}), 400
+
+        # Log a snippet of the received HTML for debugging (only sliced if DEBUG logging is enabled)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received HTML content (first 200 bytes): %s...", html_bytes[:200].decode('utf-8', 'replace'))
+
+        # Render on the conversion pool and wait for the result
+        try:
+            if _query_flag('stream') and PDF_ENGINE == 'wkhtmltopdf':
+                return _stream_pdf_response(html_bytes, options)
+            pdf_bytes = render_pdf(html_bytes, options, use_cache=_cache_requested())
+        except ConversionError as e:
+            # Return a 500 response with the details reported by the engine
+            return jsonify(e.payload), 500
+
+        # If successful, send the PDF back in the HTTP response
         # mimetype='application/pdf' is crucial for the client (n8n) to handle the data correctly.
-        # as_attachment=True suggests a download filename, though n8n consumes the binary data directly.
-        return send_file(
-            temp_pdf_file_path,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='converted.pdf' # Default filename
-        )
+        return _file_response(pdf_bytes, 'application/pdf', 'converted.pdf')
+
+    except HTTPException:
+        # Let Flask turn HTTP errors (e.g. 413 for bodies over MAX_CONTENT_LENGTH) into their proper responses
+        raise
 
     except Exception as e:
         # Catch any unexpected Python errors during the process
-        print(f"An unexpected internal error occurred: {e}")
-        sys.stdout.flush()
-        # Print the full traceback to standard output for debugging in Docker logs
-        traceback.print_exc(file=sys.stdout)
-        sys.stdout.flush()
+        # Log the full traceback for debugging in Docker logs
+        logger.exception("An unexpected internal error occurred: %s", e)
         # Return a 500 response with the error details
         return jsonify({"error": f"An internal server error occurred: {e}"}), 500
 
-    finally:
-        # Ensure temporary files are cleaned up regardless of success or failure
-        print("Cleaning up temporary files...")
-        sys.stdout.flush()
-        # Remove the temporary HTML file
-        if temp_html_file_path and os.path.exists(temp_html_file_path):
+
+def _batch_pdf_name(doc, index, used_names):
+    """
+    Returns the file name for a batch document inside the ZIP archive: the client supplied `id`
+    (a string or number, reduced to a safe base name) or `document-<n>`, made unique within the archive.
+    """
+    doc_id = doc.get('id')
+    base = os.path.basename('' if doc_id is None else str(doc_id)).strip()
+    if base.lower().endswith('.pdf'):
+        base = base[:-4]
+    if not base.strip('.'):
+        base = f"document-{index + 1}" # No id, or nothing but dots (".", "..", ".pdf") left of it
+    name = f"{base}.pdf"
+    suffix = 2
+    while name in used_names:
+        name = f"{base}-{suffix}.pdf"
+        suffix += 1
+    used_names.add(name)
+    return name
+
+
+@app.route('/convert_batch', methods=['POST'])
+def convert_batch():
+    """
+    Converts several HTML documents in one request and returns them as a ZIP archive.
+    Expects JSON body: {"docs": [{"id": "invoice-1", "html": "<div>...</div>", "opts": {...}}, ...], "opts": {...}}
+    ("id" is optional and becomes the PDF file name inside the archive; the top-level "opts" apply
+    to every document and can be overridden by a document's own "opts").
+    Returns: ZIP archive (application/zip) with one PDF per document, or JSON error message.
+    """
+    logger.debug("Received POST request to /convert_batch")
+
+    try:
+        data = _json_body()
+        docs = data.get('docs') if isinstance(data, dict) else None
+        if not isinstance(docs, list) or not docs:
+            logger.warning("Invalid batch request body, JSON with a non-empty 'docs' list is required")
+            return jsonify({"error": "Invalid request, JSON body with a non-empty 'docs' list is required"}), 400
+        # Only a missing/null "opts" means "no options"; anything else must be an object, as for /convert
+        shared_opts = data.get('opts')
+        if shared_opts is None:
+            shared_opts = {}
+        if not isinstance(shared_opts, dict):
+            return jsonify({"error": "Invalid opts: 'opts' must be an object"}), 400
+        doc_options = []
+        for index, doc in enumerate(docs):
+            if not isinstance(doc, dict) or not isinstance(doc.get('html'), str) or not doc['html']:
+                logger.warning("Batch document %d has no 'html' content", index)
+                return jsonify({"error": f"Document {index} must be an object with a non-empty 'html' key"}), 400
+            doc_id = doc.get('id')
+            if doc_id is not None and (isinstance(doc_id, bool) or not isinstance(doc_id, (str, int, float))):
+                logger.warning("Batch document %d has an invalid 'id'", index)
+                return jsonify({"error": f"Document {index} 'id' must be a string or a number"}), 400
+            own_opts = doc.get('opts')
+            if own_opts is None:
+                own_opts = {}
             try:
-                os.remove(temp_html_file_path)
-                print(f"Removed {temp_html_file_path}")
-            except OSError as e:
-                print(f"Error removing temporary html file {temp_html_file_path}: {e}")
-            sys.stdout.flush()
+                if not isinstance(own_opts, dict):
+                    raise ValueError("'opts' must be an object")
+                doc_options.append(parse_render_options({**shared_opts, **own_opts}))
+            except ValueError as e:
+                logger.warning("Invalid render options for batch document %d: %s", index, e)
+                return jsonify({"error": f"Invalid opts for document {index}: {e}"}), 400
+
+        # Queue all documents at once, so they render in parallel across the conversion pool.
+        # (wkhtmltopdf given several inputs would concatenate them into a single PDF, so every
+        # document still gets its own invocation.)
+        use_cache = _cache_requested()
+        used_names = set()
+        jobs = [
+            (_batch_pdf_name(doc, index, used_names), submit_render(doc['html'].encode('utf-8'), options, use_cache))
+            for index, (doc, options) in enumerate(zip(docs, doc_options))
+        ]
+        logger.debug("Queued %d batch documents for conversion", len(jobs))
+
+        # PDFs are already compressed internally, so they are stored in the archive without deflating them again
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for name, future in jobs:
+                try:
+                    zf.writestr(name, future.result())
+                except ConversionError as e:
+                    # Return a 500 response naming the failed document, with the details reported by the engine
+                    for _, pending in jobs:
+                        pending.cancel()
+                    return jsonify(dict(e.payload, document=name)), 500
 
-        # Remove the temporary PDF file
-        if temp_pdf_file_path and os.path.exists(temp_pdf_file_path):
-             try:
-                os.remove(temp_pdf_file_path)
-                print(f"Removed {temp_pdf_file_path}")
-             except OSError as e:
-                print(f"Error removing temporary pdf file {temp_pdf_file_path}: {e}")
-             sys.stdout.flush()
+        return _file_response(archive.getvalue(), 'application/zip', 'converted.zip')
 
-        print("Cleanup finished.")
-        sys.stdout.flush()
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.exception("An unexpected internal error occurred: %s", e)
+        return jsonify({"error": f"An internal server error occurred: {e}"}), 500
 
 
 # Entry point for the Flask development server
-# This block runs when the script is executed directly (e.g., by `flask run`).
-# In production, you would typically use a production-ready WSGI server like Gunicorn
-# (add 'gunicorn' to requirements.txt and use a Gunicorn CMD in the Dockerfile).
+# This block only runs when the script is executed directly (`python app.py`), for local testing.
+# In production the container runs the app with Gunicorn (see gunicorn.conf.py and the Dockerfile CMD).
 if __name__ == '__main__':
     # app.run() starts the development server.
     # host='0.0.0.0' makes the server accessible from any IP, including other Docker containers on the same network.
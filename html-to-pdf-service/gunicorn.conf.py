@@ -0,0 +1,68 @@
+# html-to-pdf-service/gunicorn.conf.py
+# Gunicorn configuration for the HTML-to-PDF converter.
+# Used by the Dockerfile CMD: gunicorn -c gunicorn.conf.py app:app
+import os
+
+# Rough peak memory of a single wkhtmltopdf render plus its share of the Python worker.
+# Used to keep the number of workers within the memory available to the container.
+WKHTMLTOPDF_RSS = 150 * 1024 * 1024
+
+# Concurrent wkhtmltopdf processes per worker, independent of the request thread count.
+# Exported here so app.py picks it up when it is imported.
+os.environ.setdefault('PDF_WORKERS', '2')
+
+
+def _available_memory():
+    """Returns the memory limit of the container (cgroup v2 / v1), falling back to physical RAM."""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            return int(value)
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+bind = '0.0.0.0:5000'
+
+# Memory a single worker may need: PDF_WORKERS concurrent renders plus its own PDF cache
+# (see PDF_CACHE_BYTES in app.py; PDF_CACHE_ENTRIES=0 disables the cache).
+_cache_bytes = int(os.environ.get('PDF_CACHE_BYTES', 64 * 1024 * 1024)) if int(os.environ.get('PDF_CACHE_ENTRIES', 256)) > 0 else 0
+WORKER_MEMORY = int(os.environ['PDF_WORKERS']) * WKHTMLTOPDF_RSS + _cache_bytes
+
+# Size the worker count by min(CPU count, memory / per-worker memory); GUNICORN_WORKERS overrides it.
+workers = int(os.environ.get('GUNICORN_WORKERS', max(1, min(os.cpu_count() or 1, _available_memory() // WORKER_MEMORY))))
+
+# Threaded workers: a request thread spends almost all of its time blocked on the wkhtmltopdf
+# subprocess (or on reading a large upload), which releases the GIL. Cheap request threads let
+# one worker accept uploads, answer cache hits and queue conversions concurrently, while the
+# number of wkhtmltopdf processes is bounded separately by the conversion pool (PDF_WORKERS).
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# For gthread workers this only bounds the worker's heartbeat (a worker that stops responding to the
+# arbiter), not individual requests: the conversion threads keep the worker alive while they wait.
+# How long a single conversion may take is bounded in app.py by PDF_RENDER_TIMEOUT.
+timeout = 120
+
+# Import app.py once in the master and fork the workers afterwards, so Flask, Werkzeug and the
+# module-level state are built once and shared copy-on-write instead of being re-imported per worker.
+# app.py rebuilds its thread pool and cache in each forked worker (see _reset_after_fork).
+preload_app = True
+
+# Nothing should render in the master (its threads and any engine connections would not survive
+# the fork), so the warm-up render runs in each worker after it has been forked instead.
+# Gunicorn re-executes this file on SIGHUP, when PDF_WARMUP has already been overwritten below,
+# so the user's setting is remembered in PDF_WARMUP_WORKERS the first time round.
+os.environ.setdefault('PDF_WARMUP_WORKERS', os.environ.get('PDF_WARMUP', '1'))
+_warmup = os.environ['PDF_WARMUP_WORKERS'] != '0'
+os.environ['PDF_WARMUP'] = '0'
+
+
+def post_fork(server, worker):
+    """Warms up the freshly forked worker's conversion pool."""
+    if _warmup:
+        import app
+        app.warm_up()
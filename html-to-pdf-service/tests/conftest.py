@@ -0,0 +1,52 @@
+# html-to-pdf-service/tests/conftest.py
+# Test setup: app.py is imported against stand-ins for the external programs (see tests/bin),
+# so the tests run without wkhtmltopdf, pdfunite or Xvfb installed.
+# Run with: python -m pytest html-to-pdf-service/tests
+import atexit
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+os.environ['PATH'] = os.path.join(TESTS_DIR, 'bin') + os.pathsep + os.environ.get('PATH', '')
+
+# Configuration app.py reads at import time; start from its defaults, without the warm-up render.
+for name in ('PDF_ENGINE', 'PDF_FAST_DEFAULTS', 'PDF_CACHE_ENTRIES', 'PDF_CACHE_BYTES', 'PDF_ACCEL_REDIRECT_DIR',
+             'PDF_SHARD_MIN_BYTES', 'PDF_RENDER_TIMEOUT', 'MAX_CONTENT_LENGTH', 'PDF_TEMP_DIR'):
+    os.environ.pop(name, None)
+os.environ['PDF_WARMUP'] = '0'
+os.environ['PDF_WORKERS'] = '2'
+
+# Stand-in for the shared Xvfb: app.py only checks that the display's unix socket accepts connections.
+TEST_DISPLAY = f":{4000 + os.getpid() % 1000}"
+_x_socket = f"/tmp/.X11-unix/X{TEST_DISPLAY[1:]}"
+os.makedirs('/tmp/.X11-unix', exist_ok=True)
+if os.path.exists(_x_socket):
+    os.unlink(_x_socket)
+_x_server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+_x_server.bind(_x_socket)
+_x_server.listen(16)
+atexit.register(os.unlink, _x_socket)
+
+
+def _accept_x_connections():
+    while True:
+        connection, _ = _x_server.accept()
+        connection.close()
+
+
+threading.Thread(target=_accept_x_connections, daemon=True).start()
+os.environ['DISPLAY'] = TEST_DISPLAY
+
+import app as pdf_app # noqa: E402 (must come after the environment setup above)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Flask test client with an empty PDF cache."""
+    monkeypatch.setattr(pdf_app, 'pdf_cache', pdf_app.PdfCache(pdf_app.PDF_CACHE_ENTRIES, pdf_app.PDF_CACHE_BYTES))
+    return pdf_app.app.test_client()
@@ -0,0 +1,68 @@
+import io
+import zipfile
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('doc_id, name', [
+    (None, 'document-3.pdf'),
+    ('invoice-1', 'invoice-1.pdf'),
+    ('invoice-1.PDF', 'invoice-1.pdf'),
+    ('../../etc/passwd', 'passwd.pdf'),
+    ('  ', 'document-3.pdf'),
+    ('.pdf', 'document-3.pdf'),
+    ('..', 'document-3.pdf'),
+    (0, '0.pdf'),
+    (12, '12.pdf'),
+])
+def test_batch_pdf_name(doc_id, name):
+    assert app._batch_pdf_name({'id': doc_id}, 2, set()) == name
+
+
+def test_batch_pdf_names_are_unique():
+    used = set()
+    names = [app._batch_pdf_name({'id': 'a'}, index, used) for index in range(3)]
+    assert names == ['a.pdf', 'a-2.pdf', 'a-3.pdf']
+
+
+def test_converts_documents_into_a_zip(client):
+    response = client.post('/convert_batch', json={
+        'docs': [
+            {'id': 'first', 'html': '<p>one</p>'},
+            {'html': '<p>two</p>', 'opts': {'orientation': 'Landscape'}},
+        ],
+        'opts': {'page_size': 'A5'},
+    })
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == ['first.pdf', 'document-2.pdf']
+        first, second = archive.read('first.pdf'), archive.read('document-2.pdf')
+    assert b'<p>one</p>' in first and b'--page-size A5' in first
+    assert b'--orientation Landscape' in second and b'--page-size A5' in second
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'docs': []},
+    {'docs': 'x'},
+    {'docs': [{'html': ''}]},
+    {'docs': [{'html': 5}]},
+    {'docs': [{'html': 'x', 'id': {'x': 1}}]},
+    {'docs': [{'html': 'x', 'id': True}]},
+    {'docs': [{'html': 'x'}], 'opts': []},
+    {'docs': [{'html': 'x', 'opts': 0}]},
+    {'docs': [{'html': 'x', 'opts': {'dpi': 'high'}}]},
+])
+def test_rejects_invalid_batches(client, body):
+    response = client.post('/convert_batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_failed_document_is_named(client):
+    response = client.post('/convert_batch', json={'docs': [{'id': 'ok', 'html': 'x'}, {'id': 'bad', 'html': 'FAIL'}]})
+    assert response.status_code == 500
+    assert response.json['document'] == 'bad.pdf'
@@ -0,0 +1,112 @@
+import queue
+from concurrent.futures import Future
+
+import app
+
+
+def test_converts_json_body(client):
+    response = client.post('/convert', json={'html': '<p>hello</p>', 'opts': {'page_size': 'Letter'}})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert response.data.startswith(b'%PDF')
+    assert b'<p>hello</p>' in response.data
+    assert b'--page-size Letter' in response.data
+
+
+def test_converts_raw_html_body(client):
+    response = client.post('/convert', data='<p>grüße</p>'.encode('latin-1'),
+                           content_type='text/html; charset=iso-8859-1')
+    assert response.status_code == 200
+    assert '<p>grüße</p>'.encode('utf-8') in response.data
+
+
+def test_rejects_invalid_bodies(client):
+    for body in ({}, ['html'], {'html': ''}, {'html': None}):
+        response = client.post('/convert', json=body)
+        assert response.status_code == 400, body
+    response = client.post('/convert', json={'html': 5})
+    assert response.status_code == 400
+    assert response.json == {"error": "'html' value must be a string"}
+    response = client.post('/convert', data='{not json', content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_rejects_invalid_opts(client):
+    response = client.post('/convert', json={'html': '<p>x</p>', 'opts': []})
+    assert response.status_code == 400
+    assert response.json == {"error": "Invalid opts: 'opts' must be an object"}
+
+
+def test_rejects_oversized_body(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MAX_CONTENT_LENGTH', 100)
+    response = client.post('/convert', data='x' * 200, content_type='text/html')
+    assert response.status_code == 413
+    assert 'error' in response.json
+
+
+def test_failed_conversion_returns_details(client):
+    response = client.post('/convert', json={'html': 'FAIL'})
+    assert response.status_code == 500
+    assert response.json['error'] == 'PDF conversion failed'
+    assert 'stub conversion failed' in response.json['details']
+
+
+def test_hanging_conversion_times_out(client, monkeypatch):
+    monkeypatch.setattr(app, 'PDF_RENDER_TIMEOUT', 1)
+    response = client.post('/convert', json={'html': 'HANG'})
+    assert response.status_code == 500
+    assert response.json == {"error": "PDF conversion timed out after 1s"}
+
+
+def test_results_are_cached_unless_bypassed(client):
+    client.post('/convert', json={'html': '<p>cached</p>'})
+    key = app.PdfCache.key(b'<p>cached</p>', app.parse_render_options(None))
+    assert app.pdf_cache.get(key) is not None
+
+    client.post('/convert?nocache=1', json={'html': '<p>not cached</p>'})
+    key = app.PdfCache.key(b'<p>not cached</p>', app.parse_render_options(None))
+    assert app.pdf_cache.get(key) is None
+
+
+def test_large_documents_are_split_at_markers(client, monkeypatch):
+    monkeypatch.setattr(app, 'PDF_SHARD_MIN_BYTES', 10)
+    response = client.post('/convert', json={'html': '<body>one<!--PAGEBREAK-->two</body>'})
+    assert response.status_code == 200
+    assert response.data.count(b'%PDF') == 2 # One part per page range, concatenated by the pdfunite stub
+    assert b'<body>one</body>' in response.data and b'<body>two</body>' in response.data
+
+
+def test_small_documents_get_forced_page_breaks(client):
+    response = client.post('/convert', json={'html': '<body>one<!--PAGEBREAK-->two</body>'})
+    assert response.data.count(b'%PDF') == 1
+    assert b'one' + app.PAGEBREAK_HTML + b'two' in response.data
+
+
+def test_streams_the_pdf(client):
+    response = client.post('/convert?stream=1', json={'html': '<p>streamed</p>'})
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert b'<p>streamed</p>' in response.data
+
+
+def test_stream_failure_before_output_returns_json(client):
+    response = client.post('/convert?stream=1', json={'html': 'FAIL'})
+    assert response.status_code == 500
+    assert 'stub conversion failed' in response.json['details']
+
+
+class _RacyQueue(queue.Queue):
+    """Blocking get() times out although an item is queued, as when the job finishes right after the timeout."""
+
+    def get(self, block=True, timeout=None):
+        if block:
+            raise queue.Empty
+        return super().get(block=False)
+
+
+def test_next_chunk_returns_item_queued_as_the_job_finishes():
+    chunks = _RacyQueue()
+    chunks.put((0, b''))
+    job = Future()
+    job.set_result(None)
+    assert app._next_chunk(chunks, job) == (0, b'')
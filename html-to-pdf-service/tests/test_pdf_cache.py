@@ -0,0 +1,47 @@
+from app import PdfCache
+
+
+def test_evicts_least_recently_used_entry():
+    cache = PdfCache(max_entries=2, max_bytes=1000)
+    cache.put(b'a', b'1')
+    cache.put(b'b', b'2')
+    assert cache.get(b'a') == b'1' # Makes b the least recently used entry
+    cache.put(b'c', b'3')
+    assert cache.get(b'b') is None
+    assert cache.get(b'a') == b'1'
+    assert cache.get(b'c') == b'3'
+
+
+def test_evicts_until_within_byte_budget():
+    cache = PdfCache(max_entries=10, max_bytes=10)
+    cache.put(b'a', b'x' * 4)
+    cache.put(b'b', b'x' * 4)
+    cache.put(b'c', b'x' * 4)
+    assert cache.get(b'a') is None
+    assert cache.get(b'b') is not None
+    assert cache.get(b'c') is not None
+
+
+def test_replacing_an_entry_keeps_the_size_accounting():
+    cache = PdfCache(max_entries=10, max_bytes=10)
+    cache.put(b'a', b'x' * 8)
+    cache.put(b'a', b'x' * 2)
+    cache.put(b'b', b'x' * 8)
+    assert cache.get(b'a') == b'xx'
+
+
+def test_oversized_and_disabled_caches_store_nothing():
+    cache = PdfCache(max_entries=10, max_bytes=4)
+    cache.put(b'a', b'x' * 5)
+    assert cache.get(b'a') is None
+
+    disabled = PdfCache(max_entries=0, max_bytes=1000)
+    disabled.put(b'a', b'1')
+    assert disabled.get(b'a') is None
+
+
+def test_key_depends_on_document_and_options():
+    key = PdfCache.key(b'<p>a</p>', {'dpi': 72, 'javascript': False})
+    assert key == PdfCache.key(b'<p>a</p>', {'javascript': False, 'dpi': 72})
+    assert key != PdfCache.key(b'<p>b</p>', {'dpi': 72, 'javascript': False})
+    assert key != PdfCache.key(b'<p>a</p>', {'dpi': 96, 'javascript': False})
@@ -0,0 +1,52 @@
+import pytest
+
+import app
+
+
+def test_defaults_are_the_fast_options():
+    assert app.parse_render_options(None) == app.FAST_RENDER_OPTIONS
+    assert app.parse_render_options({}) == app.FAST_RENDER_OPTIONS
+
+
+def test_client_options_override_the_defaults():
+    options = app.parse_render_options({'javascript': True, 'page_size': 'Letter'})
+    assert options['javascript'] is True
+    assert options['page_size'] == 'Letter'
+    assert options['image_quality'] == app.FAST_RENDER_OPTIONS['image_quality']
+
+
+def test_null_falls_back_to_the_engine_default():
+    options = app.parse_render_options({'lowquality': None})
+    assert 'lowquality' not in options
+
+
+@pytest.mark.parametrize('opts, message', [
+    ([], "'opts' must be an object"),
+    ('dpi', "'opts' must be an object"),
+    ({'script': 'x', 'cookie': 'y'}, "Unsupported option(s): cookie, script"),
+    ({'image_quality': 101}, "Option 'image_quality' must be an integer between 1 and 100"),
+    ({'image_quality': True}, "Option 'image_quality' must be an integer between 1 and 100"),
+    ({'javascript': 'yes'}, "Option 'javascript' must be true or false"),
+    ({'orientation': 'Sideways'}, "Option 'orientation' must be \"Portrait\" or \"Landscape\""),
+    ({'margin_top': '10mm; rm -rf'}, "Option 'margin_top' must be a length such as \"10mm\""),
+])
+def test_invalid_options_are_rejected(opts, message):
+    with pytest.raises(ValueError) as e:
+        app.parse_render_options(opts)
+    assert str(e.value) == message
+
+
+def test_wkhtmltopdf_flags():
+    flags = app._wkhtmltopdf_flags({
+        'javascript': False,
+        'lowquality': True,
+        'grayscale': False,
+        'image_quality': 75,
+        'margin_top': '10mm',
+    })
+    assert flags == [
+        '--image-quality', '75',
+        '--disable-javascript',
+        '--lowquality',
+        '--margin-top', '10mm',
+    ]
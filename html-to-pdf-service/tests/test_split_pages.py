@@ -0,0 +1,34 @@
+import app
+
+
+def test_document_without_markers_is_not_split():
+    html = b'<html><body>one</body></html>'
+    assert app._split_pages(html) == [html]
+
+
+def test_chunks_get_the_document_head_and_tail():
+    html = b'<html><head><style>p{}</style></head><body class="x">one<!--PAGEBREAK-->two</body></html>'
+    assert app._split_pages(html) == [
+        b'<html><head><style>p{}</style></head><body class="x">one</body></html>',
+        b'<html><head><style>p{}</style></head><body class="x">two</body></html>',
+    ]
+
+
+def test_body_tags_are_matched_case_insensitively():
+    html = b'<html><Body>one<!--PAGEBREAK-->two</Body ></html>'
+    assert app._split_pages(html) == [b'<html><Body>one</Body ></html>', b'<html><Body>two</Body ></html>']
+
+
+def test_empty_chunks_are_dropped():
+    html = b'<body><!--PAGEBREAK-->one<!--PAGEBREAK-->  <!--PAGEBREAK-->two<!--PAGEBREAK--></body>'
+    assert app._split_pages(html) == [b'<body>one</body>', b'<body>two</body>']
+
+
+def test_fragment_without_body():
+    assert app._split_pages(b'one<!--PAGEBREAK-->two') == [b'one', b'two']
+
+
+def test_unsplit_documents_get_forced_page_breaks():
+    assert app._with_page_breaks(b'one<!--PAGEBREAK-->two') == b'one' + app.PAGEBREAK_HTML + b'two'
+    html = b'<p>no markers</p>'
+    assert app._with_page_breaks(html) is html
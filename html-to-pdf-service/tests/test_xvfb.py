@@ -0,0 +1,32 @@
+import os
+import socket
+
+import app
+from conftest import TEST_DISPLAY
+
+
+def test_running_server_is_alive():
+    assert app._x_server_alive(TEST_DISPLAY)
+
+
+def test_leftover_socket_file_is_not_a_running_server():
+    display = ':3999'
+    path = app._x_socket_path(display)
+    if os.path.exists(path):
+        os.unlink(path)
+    # A socket file nobody listens on, as left behind by a crashed Xvfb or a restarted container
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+    try:
+        assert os.path.exists(path)
+        assert not app._x_server_alive(display)
+    finally:
+        os.unlink(path)
+
+
+def test_lock_without_live_xvfb_is_stale(tmp_path, monkeypatch):
+    lock = tmp_path / 'lock'
+    monkeypatch.setattr(app, '_x_lock_path', lambda display: str(lock))
+    assert not app._x_lock_owner_running(':3999') # No lock file
+    lock.write_text(f"{os.getpid():10d}\n") # Held by a live process that is not Xvfb
+    assert not app._x_lock_owner_running(':3999')